@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+import os
+import re
+
+import pyopencl as cl
+import numpy
+from pyopencl.characterize import has_coarse_grain_buffer_svm
+from pyopencl.tools import MemoryPool, ImmediateAllocator
+
+# Write down our kernel as a multiline string.
+# This is the batched form of vadd: every row of a, b and c is an independent vector addition.
+# The first dimension of the NDRange walks over the elements of a row, the second one over the rows.
+# The plain vadd kernel is the special case with a single row.
+kernel = """
+__kernel void vadd_batched(
+    __global const float4* a,
+    __global const float4* b,
+    __global float4* c)
+{
+    unsigned int row = get_global_id(1) * COUNT;
+    for (unsigned int i = get_global_id(0); i < COUNT; i += get_global_size(0))
+        c[row + i] = a[row + i] + b[row + i];
+}
+"""
+
+# The size of the vectors to be added together.
+vector_size = 1024
+
+# The number of vector additions done in a single kernel launch.
+# For small vectors the launch overhead dwarfs the additions, so stacking many of them into one launch amortizes it.
+batch_size = 8
+
+# Print a few of the values at the end when VERBOSE is set in the environment, e.g. VERBOSE=1.
+VERBOSE = bool(os.environ.get("VERBOSE"))
+
+# Every work item adds four contiguous floats at once through a float4 load/store.
+# The vector size has to be a multiple of this width.
+vector_width = 4
+assert vector_size % vector_width == 0
+
+# Step 1: Create a context.
+# This will ask the user to select the device to be used.
+context = cl.create_some_context()
+
+# Create a queue to the device.
+# Profiling is explicitly disabled so no per-event timing bookkeeping is done.
+# For timed runs, create a second queue with
+# cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE) and enqueue on that one instead.
+queue = cl.CommandQueue(context, properties=0)
+
+# Create a second queue for the uploads, so they can overlap with building the program.
+upload_queue = cl.CommandQueue(context, properties=0)
+
+# Create memory pools for the buffer allocations.
+# Freed buffers are kept around and handed out again instead of going back to the driver allocator.
+pool = MemoryPool(ImmediateAllocator(queue))
+pinned_pool = MemoryPool(ImmediateAllocator(queue, cl.mem_flags.ALLOC_HOST_PTR))
+
+# On devices that share their memory with the host (integrated GPUs, CPUs) the kernel can work on
+# coarse-grained shared virtual memory directly, so no data has to be copied at all.
+# Other devices use pinned host buffers that are copied to and from device memory.
+device = context.devices[0]
+use_svm = device.host_unified_memory and has_coarse_grain_buffer_svm(device)
+
+# Shape and size in bytes of each batch of vectors.
+shape = (batch_size, vector_size)
+nbytes = batch_size * vector_size * numpy.dtype(numpy.float32).itemsize
+
+# Random number generator for the input vectors.
+rng = numpy.random.default_rng()
+
+if use_svm:
+    # The host arrays live in shared virtual memory and are passed to the kernel as they are.
+    # Coarse-grained SVM has to be mapped while the host accesses it.
+    h_a = cl.svm_empty(context, cl.svm_mem_flags.READ_ONLY, shape, numpy.float32, alignment=64)
+    h_b = cl.svm_empty(context, cl.svm_mem_flags.READ_ONLY, shape, numpy.float32, alignment=64)
+    h_c = cl.svm_empty(context, cl.svm_mem_flags.WRITE_ONLY, shape, numpy.float32, alignment=64)
+    with cl.SVM(h_a).map_rw(queue) as a, cl.SVM(h_b).map_rw(queue) as b:
+        rng.random(shape, dtype=numpy.float32, out=a)
+        rng.random(shape, dtype=numpy.float32, out=b)
+    d_a = cl.SVM(h_a)
+    d_b = cl.SVM(h_b)
+    d_c = cl.SVM(h_c)
+    uploads = []
+else:
+    # Create pinned host buffers for the batches of input vectors A and B.
+    # ALLOC_HOST_PTR lets the driver own page-locked memory, so transfers from it can be DMA'd
+    # directly instead of being staged through an internal bounce buffer.
+    # The numpy arrays are views on the mapped pinned memory and are filled in place.
+    pinned_a = pinned_pool.allocate(nbytes)
+    pinned_b = pinned_pool.allocate(nbytes)
+
+    map_flags = cl.map_flags.READ | cl.map_flags.WRITE
+    h_a, _ = cl.enqueue_map_buffer(queue, pinned_a, map_flags, 0, shape, numpy.float32)
+    h_b, _ = cl.enqueue_map_buffer(queue, pinned_b, map_flags, 0, shape, numpy.float32)
+
+    # Generate float32 random numbers straight into the pinned memory, without a float64 temporary.
+    rng.random(shape, dtype=numpy.float32, out=h_a)
+    rng.random(shape, dtype=numpy.float32, out=h_b)
+
+    # Send the data to the guest memory.
+    d_a = pool.allocate(nbytes)
+    d_b = pool.allocate(nbytes)
+    upload_a = cl.enqueue_copy(upload_queue, d_a, h_a, is_blocking=False)
+    upload_b = cl.enqueue_copy(upload_queue, d_b, h_b, is_blocking=False)
+    upload_queue.flush()
+    uploads = [upload_a, upload_b]
+
+    # Create an array on the device for the result.
+    # It is allocated from pinned memory as well so it can be mapped for reading afterwards.
+    d_c = pinned_pool.allocate(nbytes)
+
+# The number of float4 elements per row is baked into the kernel as the compile-time constant COUNT instead of
+# being passed as an argument, so the compiler can fold it into the loop.
+options = ["-DCOUNT={}".format(vector_size // vector_width)]
+
+# Create the program. pyopencl caches the compiled binaries on disk, so later runs skip the compilation.
+program = cl.Program(context, kernel).build(options=options)
+
+# Initiate the kernel.
+vadd_batched = program.vadd_batched
+
+# Launch a fixed number of work items per row, a few per compute unit, and let each one stride over its row.
+global_size = min(vector_size // vector_width, 256 * device.max_compute_units)
+
+# Pick the work-group size for the device: a wave64 on AMD GCN GPUs, a warp/wave32 on NVIDIA and AMD RDNA GPUs
+# and 256 otherwise. The global size is rounded up to a multiple of it; the kernel loop bounds the extra work items.
+local_size = 256
+if device.type & cl.device_type.GPU:
+    vendor = device.vendor.upper()
+    if "NVIDIA" in vendor:
+        local_size = 32
+    elif "AMD" in vendor or "ADVANCED MICRO DEVICES" in vendor:
+        local_size = 32 if re.match(r"gfx1\d{3}", device.name) else 64
+local_size = min(local_size, vadd_batched.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device))
+global_size = -(-global_size // local_size) * local_size
+
+# Execute C = A + B for every row in a single launch.
+vadd_batched(queue, (global_size, batch_size), (local_size, 1), d_a, d_b, d_c, wait_for=uploads)
+
+# Wait for the queue to be completely processed.
+queue.finish()
+
+# Map the result for reading instead of copying it back.
+# On devices that share memory with the host this avoids the copy altogether.
+if use_svm:
+    host_maps = [cl.SVM(h).map_ro(queue) for h in (h_a, h_b, h_c)]
+else:
+    h_c, _ = cl.enqueue_map_buffer(queue, d_c, cl.map_flags.READ, 0, shape, numpy.float32)
+    host_maps = [h.base for h in (h_a, h_b, h_c)]
+
+# Verify the solution.
+tolerance = 0.001
+
+# Expected result
+expected = h_a + h_b
+# Compare with the relative tolerance, plus a small absolute one so expected values near zero
+# don't need a division that could blow up.
+ok = numpy.isclose(h_c, expected, rtol=tolerance, atol=1e-6)
+
+# Print the row and index of the elements that are wrong.
+wrong = numpy.argwhere(~ok)
+correct = h_c.size - len(wrong)
+for row, i in wrong:
+    print(row, i, " is wrong")
+# Only print the values when run as a script in verbose mode, since that converts them to python objects.
+if __name__ == "__main__" and VERBOSE:
+    print(h_c[0, :8], "...")
+
+# Unmap the host views again now that the host is done reading them.
+# The pinned buffer maps and the SVM maps are both released the same way.
+for host_map in host_maps:
+    host_map.release()
+queue.finish()
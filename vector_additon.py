@@ -1,5 +1,10 @@
+import os
+import re
+
 import pyopencl as cl
 import numpy
+from pyopencl.characterize import has_coarse_grain_buffer_svm
+from pyopencl.tools import MemoryPool, ImmediateAllocator
 
 # The kernel in Python can be written down as an inline string, or it can be an external file.
 # In most exercises the kernel will be inlined into the file.
@@ -7,30 +12,43 @@ kernel = """
 // Each kernel will take a few arguments. In this case we need to add two vectors together.
 // This means that we will have at least two inputs, but also one output vector to store our result in.
 // Of course you could add into one of both input vectors, too.
-// Additionally we add the count which holds the size of the vector.
-// This value can be a parameter, or it can be inlined into the string as a constant.
-// This is where string formatting in python comes in handy.
+// Additionally we need the count which holds the size of the vector, measured in float4 elements.
+// This value can be a parameter, or it can be inlined into the kernel as a constant.
+// Here it is a constant: COUNT is defined when the program is built, with the -D compiler option.
+// Because the compiler knows the value, it can fold it into the loop instead of reading an argument.
 // However, the goal of this course is not to make you a better python programmer, but a better opencl programmer.
 __kernel void vadd(
-    __global float* a,
-    __global float* b,
-    __global float* c,
-    const unsigned int count)
+    __global const float4* a,
+    __global const float4* b,
+    __global float4* c)
 {
     // get_global_id gives you the details which identifier the current workitem has received.
     // This is unique for every work item and can be used to index into an array.
-    // Here each work item will add the ith element from the vector.
-    // All work items outside of the 0-count range will not do anything.
-    unsigned int i = get_global_id(0);
-    if (i < count)
+    // Here each work item will add the ith float4 from the vector, which covers four contiguous floats.
+    // Loading four floats at once means fewer, wider memory transactions than one float per work item.
+    // get_global_size gives you the total number of work items that were launched.
+    // Instead of launching one work item per element, each work item strides over the vector in steps
+    // of the global size (a grid-stride loop), so a much smaller launch still covers all elements.
+    // The loop condition also keeps work items from going outside of the 0-COUNT range.
+    for (unsigned int i = get_global_id(0); i < COUNT; i += get_global_size(0))
         c[i] = a[i] + b[i];
 }
 
 """
 
 # The size of the vectors to be added together.
+# At this size the kernel launch overhead is larger than the additions themselves.
+# If you need many of these additions, batched_vec_addition.py stacks them as rows into a single launch.
 vector_size = 1024
 
+# Print a few of the values at the end when VERBOSE is set in the environment, e.g. VERBOSE=1.
+VERBOSE = bool(os.environ.get("VERBOSE"))
+
+# Every work item adds four contiguous floats at once through a float4 load/store.
+# The vector size has to be a multiple of this width.
+vector_width = 4
+assert vector_size % vector_width == 0
+
 # Step 1: Create a context.
 # This will ask the user to select the device to be used.
 # Can be automatic, too by setting the environment variable PYOPENCL_CTX.
@@ -38,74 +56,179 @@ vector_size = 1024
 context = cl.create_some_context()
 
 # Create a queue to the device.
-queue = cl.CommandQueue(context)
+# The queue is created with properties=0, so profiling is disabled. With PROFILING_ENABLE the driver records
+# timestamps for every event, which makes every enqueue a bit slower.
+# If you want to time the kernel, create a second queue just for the timed runs:
+# profiling_queue = cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE)
+# https://documen.tician.de/pyopencl/runtime_queue.html#pyopencl.CommandQueue
+queue = cl.CommandQueue(context, properties=0)
+
+# Create a second queue that is only used for uploading the input vectors.
+# Commands on different queues don't have to wait for each other, so the uploads can run while the
+# program is being built. The kernel launch waits for the uploads through their events.
+upload_queue = cl.CommandQueue(context, properties=0)
+
+# Create memory pools for the buffer allocations.
+# Every cl.Buffer is a call into the driver allocator, which is expensive when it happens often.
+# A memory pool keeps freed buffers around and hands them out again on the next allocation of a similar size.
+# The second pool hands out pinned host memory, see ALLOC_HOST_PTR below.
+# https://documen.tician.de/pyopencl/tools.html#memory-pools
+pool = MemoryPool(ImmediateAllocator(queue))
+pinned_pool = MemoryPool(ImmediateAllocator(queue, cl.mem_flags.ALLOC_HOST_PTR))
+
+# Shared virtual memory (SVM) lets the host and the device use the same pointers.
+# On devices that share their memory with the host, like integrated GPUs and CPUs, the kernel can then work
+# directly on the arrays the host filled in, so no data has to be copied to or from the device at all.
+# With coarse-grained SVM the host still has to map the memory while it reads or writes it.
+# Discrete GPUs have their own memory, so for them pinned host buffers are copied to device buffers instead.
+# https://documen.tician.de/pyopencl/runtime_memory.html#shared-virtual-memory-svm
+device = context.devices[0]
+use_svm = device.host_unified_memory and has_coarse_grain_buffer_svm(device)
+
+# Size in bytes of each vector.
+nbytes = vector_size * numpy.dtype(numpy.float32).itemsize
+
+# Generate the random numbers as float32 straight into the host memory.
+# numpy.random.rand would create a float64 array first that then has to be converted and copied.
+rng = numpy.random.default_rng()
+
+if use_svm:
+    # Allocate the vectors in shared virtual memory. These numpy arrays can be passed to the kernel as they are.
+    h_a = cl.svm_empty(context, cl.svm_mem_flags.READ_ONLY, vector_size, numpy.float32, alignment=64)
+    h_b = cl.svm_empty(context, cl.svm_mem_flags.READ_ONLY, vector_size, numpy.float32, alignment=64)
+    h_c = cl.svm_empty(context, cl.svm_mem_flags.WRITE_ONLY, vector_size, numpy.float32, alignment=64)
+
+    # Map the inputs while the host fills them. They are unmapped again at the end of the with block.
+    with cl.SVM(h_a).map_rw(queue) as a, cl.SVM(h_b).map_rw(queue) as b:
+        rng.random(vector_size, dtype=numpy.float32, out=a)
+        rng.random(vector_size, dtype=numpy.float32, out=b)
+
+    # The kernel arguments are the SVM arrays themselves, and there is nothing to upload.
+    d_a = cl.SVM(h_a)
+    d_b = cl.SVM(h_b)
+    d_c = cl.SVM(h_c)
+    uploads = []
+else:
+    # Create pinned host buffers for the two vectors to be added.
+    # ALLOC_HOST_PTR :: This flag specifies that the application wants the OpenCL implementation
+    #                   to allocate memory from host accessible memory. The driver owns this
+    #                   page-locked (pinned) memory, so transfers from it can be DMA'd directly
+    #                   instead of being staged through an internal bounce buffer first.
+    pinned_a = pinned_pool.allocate(nbytes)
+    pinned_b = pinned_pool.allocate(nbytes)
+
+    # Map the pinned buffers so they can be used as numpy arrays on the host and fill them in place.
+    # https://documen.tician.de/pyopencl/runtime_memory.html#pyopencl.enqueue_map_buffer
+    map_flags = cl.map_flags.READ | cl.map_flags.WRITE
+    h_a, _ = cl.enqueue_map_buffer(queue, pinned_a, map_flags, 0, (vector_size,), numpy.float32)
+    h_b, _ = cl.enqueue_map_buffer(queue, pinned_b, map_flags, 0, (vector_size,), numpy.float32)
+
+    # Generate the random numbers as float32 straight into the pinned memory.
+    rng.random(vector_size, dtype=numpy.float32, out=h_a)
+    rng.random(vector_size, dtype=numpy.float32, out=h_b)
+
+    # Send the data to the guest memory.
+    # The device buffers come from the pool, which allocates them as CL_MEM_READ_WRITE.
+    d_a = pool.allocate(nbytes)
+    d_b = pool.allocate(nbytes)
+    upload_a = cl.enqueue_copy(upload_queue, d_a, h_a, is_blocking=False)
+    upload_b = cl.enqueue_copy(upload_queue, d_b, h_b, is_blocking=False)
+    upload_queue.flush()
+    uploads = [upload_a, upload_b]
+
+    # Create the memory on the device to put the result into.
+    # It is allocated from pinned memory as well so it can be mapped for reading afterwards.
+    d_c = pinned_pool.allocate(nbytes)
+
+# Define COUNT for the kernel, the number of float4 elements in a vector.
+# -D works just like #define in the kernel source. Since vector_size is known before the program is built,
+# there is no need to pass it as a kernel argument at runtime.
+options = ["-DCOUNT={}".format(vector_size // vector_width)]
 
 # Create the program.
-program = cl.Program(context, kernel).build()
-
-# Create two vectors to be added.
-h_a = numpy.random.rand(vector_size).astype(numpy.float32)
-h_b = numpy.random.rand(vector_size).astype(numpy.float32)
-
-# Create the result vector.
-h_c = numpy.empty(vector_size).astype(numpy.float32)
-
-# Send the data to the guest memory.
-# COPY_HOST_PTR     :: If specified, it indicates that the application wants the
-#                      OpenCL implementation to allocate memory for the memory
-#                      object and copy the data from memory referenced by host_ptr
-# CL_MEM_READ_ONLY  :: This flag specifies that the memory object is a read-only
-#                      memory object when used inside a kernel.Writing to a buffer
-#                      or image object created with CL_MEM_READ_ONLY inside a kernel is undefined.
-# CL_MEM_WRITE_ONLY :: This flags specifies that the memory object will be written but not
-#                      read by a kernel.Reading from a buffer or image object created with
-#                      CL_MEM_WRITE_ONLY inside a kernel is undefined.
-d_a = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=h_a)
-d_b = cl.Buffer(context, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=h_b)
-
-# Create the memory on the device to put the result into.
-d_c = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, h_c.nbytes)
+# Building the program compiles the kernel for the device, which can take tens to hundreds of milliseconds.
+# pyopencl caches the compiled binaries on disk, keyed by the source, the build options and the device,
+# so later runs skip the compilation.
+# https://documen.tician.de/pyopencl/runtime_program.html#pyopencl.Program
+program = cl.Program(context, kernel).build(options=options)
 
 # Execute the kernel.
 # Here you can reference multiple kernels. For didactic purposes I copied the kernel and gave it slightly different name.
 # You can reference both kernels here.
 vadd = program.vadd
 
-# https://documen.tician.de/pyopencl/runtime_program.html?highlight=set_scalar_arg_dtypes#pyopencl.Kernel.set_scalar_arg_dtypes
-vadd.set_scalar_arg_dtypes([None, None, None, numpy.uint32])
-
 # https://documen.tician.de/pyopencl/runtime_program.html?highlight=set_scalar_arg_dtypes#pyopencl.Kernel.__call__
-vadd(queue, h_a.shape, None, d_a, d_b, d_c, vector_size)
+# The global size is not tied to the vector size anymore because of the grid-stride loop in the kernel.
+# A few work items per compute unit are enough to keep the device busy, and launching fewer of them
+# amortizes the setup cost of every work item over more additions.
+# It never has to be larger than the number of float4 elements, though.
+global_size = min(vector_size // vector_width, 256 * device.max_compute_units)
+
+# The third argument is the local size, the number of work items in a work-group.
+# Passing None lets the driver pick one, which is often not a good fit for the hardware.
+# Work items are executed in lockstep groups: wavefronts of 64 on AMD GCN, and warps/waves of 32 on NVIDIA and AMD RDNA
+# (whose device names start with gfx10 or newer). Matching the work-group size to that keeps every lane busy.
+# CPU devices can report the CPU vendor (e.g. AuthenticAMD), so the table only applies to GPUs.
+# For other devices 256 is a reasonable default. It can never be larger than what the device supports for this kernel,
+# which can be less than the device maximum, e.g. when the kernel uses many registers.
+local_size = 256
+if device.type & cl.device_type.GPU:
+    vendor = device.vendor.upper()
+    if "NVIDIA" in vendor:
+        local_size = 32
+    elif "AMD" in vendor or "ADVANCED MICRO DEVICES" in vendor:
+        local_size = 32 if re.match(r"gfx1\d{3}", device.name) else 64
+local_size = min(local_size, vadd.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device))
+
+# The global size has to be a multiple of the local size, so round it up.
+# The loop condition in the kernel makes sure the extra work items don't go out of bounds.
+global_size = -(-global_size // local_size) * local_size
+vadd(queue, (global_size,), (local_size,), d_a, d_b, d_c, wait_for=uploads)
 
 # Wait for the queue to be completely processed.
 # https://www.khronos.org/registry/OpenCL/sdk/1.0/docs/man/xhtml/clFinish.html
 queue.finish()
 
-# Read the array from the device.
-# https://documen.tician.de/pyopencl/runtime_memory.html?highlight=enqueue_copy#pyopencl.enqueue_copy
-cl.enqueue_copy(queue, h_c, d_c)
+# Map the result for reading instead of copying it back to a separate host array.
+# The host only needs read access, and on devices that share memory with the host (integrated GPUs, CPUs)
+# the driver can hand out the buffer directly without any copy.
+# https://documen.tician.de/pyopencl/runtime_memory.html#pyopencl.enqueue_map_buffer
+# With SVM the inputs and the result are mapped for reading, so the host can verify them.
+if use_svm:
+    host_maps = [cl.SVM(h).map_ro(queue) for h in (h_a, h_b, h_c)]
+else:
+    h_c, _ = cl.enqueue_map_buffer(queue, d_c, cl.map_flags.READ, 0, (vector_size,), numpy.float32)
+    host_maps = [h.base for h in (h_a, h_b, h_c)]
 
 # Verify the solution.
-correct = 0
 tolerance = 0.001
 
 # This part of the code will verify our solution. We are dealing with floating point numbers so we have to keep in mind that there can be small deviations from the actual result.
 # Therefore we compute the so-called fault-tolerance.
-# We take the absolute difference between the expected result and actual result, and divide it by the expected result. This yields the relative error rate.
-# It should not be more than 0.001.
-for i in range(vector_size):
-    # Expected result
-    expected = h_a[i] + h_b[i]
-    actual = h_c[i]
-    # Compute the relative error
-    relative_error = numpy.absolute((actual - expected) / expected)
-
-    # Print the index if it's wrong.
-    if relative_error < tolerance:
-        correct += 1
-    else:
-        print(i, " is wrong")
-print(h_a[:10])
-print(h_b[:10])
-
-print(h_c[:10])
\ No newline at end of file
+# We take the absolute difference between the expected result and actual result, and compare it to 0.001 times the expected result.
+# This is the relative error rate, without actually dividing by the expected result, which could be (close to) zero.
+# A tiny absolute tolerance is added on top of that for those values near zero.
+# The whole check is done with vectorized numpy operations instead of a python loop per element.
+# Expected result
+expected = h_a + h_b
+# https://numpy.org/doc/stable/reference/generated/numpy.isclose.html
+ok = numpy.isclose(h_c, expected, rtol=tolerance, atol=1e-6)
+
+# Print the indices that are wrong.
+wrong = numpy.flatnonzero(~ok)
+correct = vector_size - len(wrong)
+for i in wrong:
+    print(i, " is wrong")
+# Only print the values when run as a script in verbose mode.
+# Printing converts the values to python objects, which is slow and only useful for debugging.
+if __name__ == "__main__" and VERBOSE:
+    print(h_a[:8], "...")
+    print(h_b[:8], "...")
+    print(h_c[:8], "...")
+
+# Unmap the host views again now that the host is done reading them.
+# The pinned buffer maps and the SVM maps are both released the same way.
+# https://documen.tician.de/pyopencl/runtime_memory.html#pyopencl.MemoryMap.release
+for host_map in host_maps:
+    host_map.release()
+queue.finish()